@@ -0,0 +1,408 @@
+__author__ = 'andreas.hove'
+
+import argparse
+import asyncio
+import json
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import FeistelCipher
+import RSACipher
+
+# Local asyncio service for the Feistel and RSA ciphers, plus a load generator client.
+#
+#   python CipherService.py serve --port 8765            (or --unix /tmp/cipher.sock)
+#   python CipherService.py load --port 8765 --requests 2000 --concurrency 32
+#
+# Every message is a frame: a 4-byte header length and a 4-byte payload length (big-endian), a JSON
+# header and the raw payload. Requests carry an "id" and an "op":
+#
+#   feistel-encrypt, feistel-decrypt   payload is the data, header has "codeword" and optionally "rounds"
+#   rsa-encrypt, rsa-decrypt           header has "blocks", a list of ints, with the service's key
+#   rsa-key                            returns the public key "n" and "e"
+#   stats                              returns latency histograms per op
+#
+# Responses repeat the "id", have "ok" and either the result or an "error". A connection may have many
+# requests in flight and responses can come back out of order.
+#
+# Small requests run on the event loop. The service times a Feistel encryption and an RSA encryption and
+# decryption with its key when it starts, and from those estimates the CPU time of every request; requests
+# estimated above inlineLimit seconds (1 ms by default) go to a process pool, so the loop never blocks on
+# roundfunction or fast_exponentiation for longer than that. At most `concurrency` requests are processed
+# at once over all connections, and at most `pipeline` per connection. A connection only takes one of the
+# `concurrency` slots once a whole frame has arrived, so idle connections hold none. When either limit is
+# reached the service stops reading from that socket, which pushes back on the client through TCP flow
+# control.
+
+FRAME = struct.Struct('>II')
+
+
+async def readFrame(reader, maxFrame):
+    headerLength, payloadLength = FRAME.unpack(await reader.readexactly(FRAME.size))
+    if headerLength + payloadLength > maxFrame:
+        raise ValueError("frame of {} bytes is larger than the limit of {}".format(
+            headerLength + payloadLength, maxFrame))
+
+    header = json.loads(await reader.readexactly(headerLength))
+    payload = await reader.readexactly(payloadLength)
+    if not isinstance(header, dict):
+        raise ValueError("frame header must be a JSON object")
+    return header, payload
+
+
+def encodeFrame(header, payload=b''):
+    header = json.dumps(header).encode('utf-8')
+    return FRAME.pack(len(header), len(payload)) + header + payload
+
+
+'''######### JOBS #########'''
+# Module-level functions, so they can be sent to the process pool.
+
+def feistelJob(op, payload, codeword, rounds):
+    if op == 'feistel-encrypt':
+        return {}, bytes(FeistelCipher.encrypt(payload, codeword, rounds))
+    return {}, bytes(FeistelCipher.decrypt(payload, codeword, rounds))
+
+
+def rsaJob(op, blocks, key):
+    if op == 'rsa-encrypt':
+        return {'blocks': [key.encrypt(m) for m in blocks]}, b''
+    return {'blocks': key.decrypt_many(blocks)}, b''
+
+
+'''######### METRICS #########'''
+
+class LatencyHistogram:
+    '''
+    Counts latencies in buckets that double in width, bucket i holds latencies below 2**i microseconds.
+    Percentiles are reported as the upper bound of the bucket they fall in.
+    '''
+    BUCKETS = 40
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return 2**bucket / 1e6
+        return 0.0
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(50), 'p99': self.percentile(99), 'max': self.max}
+
+
+'''######### SERVICE #########'''
+
+class CipherService:
+    '''
+    Serves framed encrypt/decrypt requests. An RSA key of keysize bits is generated when the service
+    starts, or passed in as an RSACipher.PrivateKey.
+    '''
+
+    def __init__(self, keysize=1024, key=None, concurrency=64, inlineLimit=0.001, workers=None,
+                 maxFrame=64 << 20, pipeline=16):
+        self.key = key if key is not None else RSACipher.generate_key(keysize)
+        self.costs = self.calibrate()
+        self.concurrency = concurrency
+        self.pipeline = pipeline
+        self.inlineLimit = inlineLimit
+        self.workers = workers
+        self.maxFrame = maxFrame
+        self.histograms = {}
+        self.handlers = {}
+        self.server = None
+        self.executor = None
+        self.limit = None
+
+    def calibrate(self, repeat=3):
+        '''
+        Seconds of CPU time for: setting up a new Feistel codeword, encrypting one byte with 16 rounds,
+        and one RSA block encryption and decryption with the service's key. The fastest of `repeat`
+        runs is used.
+        '''
+        def fastest(function):
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                function()
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        data = bytes(1024)
+        block = self.key.encrypt(2)
+        return {
+            'feistelKey': fastest(lambda: FeistelCipher.KeySchedule(os.urandom(8).hex()[:8])),
+            'feistelByte': fastest(lambda: FeistelCipher.encrypt(data, 'calibrat')) / len(data),
+            'rsa-encrypt': fastest(lambda: self.key.encrypt(2)),
+            'rsa-decrypt': fastest(lambda: self.key.decrypt(block)),
+        }
+
+    def estimate(self, op, header, payload):
+        # estimated CPU seconds for a feistel or rsa request; a codeword is counted as new every time
+        if op.startswith('feistel'):
+            costs = self.costs
+            return costs['feistelKey'] + len(payload) * costs['feistelByte'] * header.get('rounds', 16) / 16
+        return len(header['blocks']) * self.costs[op]
+
+    async def start(self, host='127.0.0.1', port=8765, unix=None):
+        self.limit = asyncio.Semaphore(self.concurrency)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        if unix is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path=unix)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+        # aborting the connections ends the handlers at their next read, and responses that a client is
+        # not reading are dropped instead of waiting in drain() forever
+        for writer in list(self.handlers.values()):
+            writer.transport.abort()
+        if self.handlers:
+            await asyncio.gather(*self.handlers, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    async def handle(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+        inFlight = asyncio.Semaphore(self.pipeline)
+        self.handlers[asyncio.current_task()] = writer
+
+        try:
+            while True:
+                # this connection's own limit bounds the frames read but not yet answered
+                await inFlight.acquire()
+                try:
+                    header, payload = await readFrame(reader, self.maxFrame)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    inFlight.release()
+                    break
+                except ValueError as error:
+                    inFlight.release()
+                    writer.write(encodeFrame({'ok': False, 'error': str(error)}))
+                    break
+                except BaseException:
+                    inFlight.release()
+                    raise
+
+                # a service-wide slot is only taken once there is a request to process
+                try:
+                    await self.limit.acquire()
+                except BaseException:
+                    inFlight.release()
+                    raise
+
+                # both slots are held until the response is written and drained (or the task is cancelled),
+                # so a client that does not read its responses stops being served instead of filling buffers
+                task = asyncio.ensure_future(self.respond(header, payload, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda task: (self.limit.release(), inFlight.release()))
+
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            del self.handlers[asyncio.current_task()]
+            writer.close()
+
+    async def respond(self, header, payload, writer, lock):
+        start = time.perf_counter()
+        op = None
+
+        try:
+            op = header.get('op')
+            result, output = await self.run(op, header, payload)
+            response = dict(result, id=header.get('id'), ok=True)
+        except Exception as error:
+            response, output = {'id': header.get('id'), 'ok': False, 'error': str(error)}, b''
+
+        self.histograms.setdefault(op, LatencyHistogram()).record(time.perf_counter() - start)
+
+        async with lock:
+            writer.write(encodeFrame(response, output))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def run(self, op, header, payload):
+        if op in ('feistel-encrypt', 'feistel-decrypt'):
+            job = (feistelJob, op, payload, header['codeword'], header.get('rounds', 16))
+        elif op in ('rsa-encrypt', 'rsa-decrypt'):
+            job = (rsaJob, op, [int(block) for block in header['blocks']], self.key)
+        elif op == 'rsa-key':
+            return {'n': self.key.n, 'e': self.key.e}, b''
+        elif op == 'stats':
+            return {'latency': {name: histogram.summary() for name, histogram in self.histograms.items()}}, b''
+        else:
+            raise ValueError("unknown op '{}'".format(op))
+
+        if self.estimate(op, header, payload) <= self.inlineLimit:
+            return job[0](*job[1:])
+        return await asyncio.get_running_loop().run_in_executor(self.executor, *job)
+
+
+'''######### CLIENT #########'''
+
+class CipherClient:
+    '''
+    Pipelining client: any number of requests can be awaited at once over one connection.
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.nextId = 0
+        self.error = None
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=8765, unix=None):
+        if unix is not None:
+            return cls(*await asyncio.open_unix_connection(unix))
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def receive(self):
+        try:
+            while True:
+                header, payload = await readFrame(self.reader, 1 << 62)
+                future = self.pending.pop(header.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result((header, payload))
+        except Exception as error:
+            # a closed connection or a frame that can't be parsed: nothing more will be answered
+            self.error = "connection closed: {!r}".format(error)
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(self.error))
+            self.pending.clear()
+
+    async def request(self, op, payload=b'', **params):
+        if self.error is not None:
+            raise ConnectionError(self.error)
+        self.nextId += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.nextId] = future
+
+        self.writer.write(encodeFrame(dict(params, id=self.nextId, op=op), payload))
+        await self.writer.drain()
+
+        header, payload = await future
+        if not header['ok']:
+            raise RuntimeError(header['error'])
+        return header, payload
+
+    async def close(self):
+        self.receiver.cancel()
+        self.writer.close()
+
+
+async def runLoad(client, requests=1000, concurrency=16, size=256, op='feistel-encrypt', codeword='abcdefgh'):
+    '''
+    Sends `requests` requests with at most `concurrency` in flight and returns requests/sec and the
+    p50/p99 latency in seconds.
+    '''
+    payload = os.urandom(size)
+    params = {'codeword': codeword}
+    if op.startswith('rsa'):
+        n = (await client.request('rsa-key'))[0]['n']
+        payload, params = b'', {'blocks': [int.from_bytes(os.urandom(8), 'big') % n for _ in range(max(1, size // 8))]}
+
+    latencies = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with slots:
+            start = time.perf_counter()
+            await client.request(op, payload, **params)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {'requests': requests, 'seconds': elapsed, 'rps': requests / elapsed,
+            'p50': latencies[len(latencies) // 2], 'p99': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]}
+
+
+'''######### MAIN METHOD #########'''
+
+async def serve(args):
+    service = CipherService(args.keysize, concurrency=args.concurrency, inlineLimit=args.inline_limit,
+                            workers=args.workers, pipeline=args.pipeline)
+    await service.start(args.host, args.port, args.unix)
+    print("Serving on {}".format(args.unix or "{}:{}".format(args.host, args.port)))
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.close()
+
+
+async def load(args):
+    client = await CipherClient.connect(args.host, args.port, args.unix)
+    try:
+        result = await runLoad(client, args.requests, args.concurrency, args.size, args.op)
+    finally:
+        await client.close()
+
+    print("{requests} requests in {seconds:.3f}s: {rps:.1f} req/s, p50 {p50_ms:.3f} ms, p99 {p99_ms:.3f} ms".format(
+        p50_ms=result['p50'] * 1e3, p99_ms=result['p99'] * 1e3, **result))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Feistel/RSA encryption service and load generator.")
+    parser.add_argument('command', choices=('serve', 'load'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help="unix socket path, instead of TCP")
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help="serve: requests processed at once (64), load: requests in flight (16)")
+    parser.add_argument('--pipeline', type=int, default=16, help="serve: requests in flight per connection")
+    parser.add_argument('--keysize', type=int, default=1024, help="serve: RSA key size in bits")
+    parser.add_argument('--inline-limit', type=float, default=0.001,
+                        help="serve: requests estimated to take more CPU seconds than this go to the process pool")
+    parser.add_argument('--workers', type=int, default=None, help="serve: process pool size")
+    parser.add_argument('--requests', type=int, default=1000, help="load: number of requests")
+    parser.add_argument('--size', type=int, default=256, help="load: payload bytes per request")
+    parser.add_argument('--op', default='feistel-encrypt', help="load: op to send")
+    args = parser.parse_args(argv)
+
+    if args.concurrency is None:
+        args.concurrency = 64 if args.command == 'serve' else 16
+
+    try:
+        asyncio.run(serve(args) if args.command == 'serve' else load(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
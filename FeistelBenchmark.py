@@ -0,0 +1,125 @@
+__author__ = 'andreas.hove'
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+
+import FeistelCipher
+
+# Benchmark suite for the Feistel cipher.
+#
+# Measures key schedule setup, per-block latency of both backends, bulk throughput of encrypt() at
+# several message sizes, and the time spent in each stage of the list backend (through
+# FeistelCipher.instrumented). The results are written as JSON so they can be compared between releases:
+#
+#   python FeistelBenchmark.py --output results.json
+
+
+MESSAGE_SIZES = (16, 1024, 65536)
+CODEWORD = 'abcdefgh'
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmarkKeySchedule(repeat=200, rounds=16):
+    key = FeistelCipher.tobits(CODEWORD)
+    cache = FeistelCipher.KeyScheduleCache()
+    cache.get(CODEWORD, rounds)
+
+    return {
+        'uncachedSeconds': timeit(lambda: FeistelCipher.subkeyGenerator(key, rounds), repeat),
+        'cachedSeconds': timeit(lambda: cache.get(CODEWORD, rounds), repeat),
+    }
+
+
+def benchmarkBlockLatency(blocks=500, rounds=16):
+    # each backend on its own block type, like FeistelCipher.benchmark(), so no conversions are timed
+    subkeys = FeistelCipher.getSubkeys(CODEWORD, rounds)
+    words = [random.getrandbits(64) for _ in range(blocks)]
+    runs = {'list': (FeistelCipher.encryptBlock, [FeistelCipher.intToBits(word, 64) for word in words],
+                     [FeistelCipher.intToBits(subkey, 48) for subkey in subkeys]),
+            'int': (FeistelCipher.encryptBlockInt, words, subkeys)}
+    results = {}
+
+    for backend in FeistelCipher.BACKENDS:
+        encryptBlock, data, backendKeys = runs[backend]
+
+        start = time.perf_counter()
+        for block in data:
+            encryptBlock(block, rounds, backendKeys)
+        results[backend] = (time.perf_counter() - start) / blocks
+
+    return {'secondsPerBlock': results}
+
+
+def benchmarkThroughput(sizes=MESSAGE_SIZES, rounds=16):
+    schedule = FeistelCipher.KeySchedule(CODEWORD, rounds)
+    results = {}
+
+    for size in sizes:
+        data = os.urandom(size)
+        repeat = max(1, 65536 // size)
+        seconds = timeit(lambda: FeistelCipher.encrypt(data, schedule), repeat)
+        results[str(size)] = {'seconds': seconds, 'bytesPerSecond': size / seconds}
+
+    return results
+
+
+def benchmarkStages(length=256, rounds=16):
+    subkeys = FeistelCipher.subkeyGenerator(FeistelCipher.tobits(CODEWORD), rounds)
+    text = ''.join(chr(random.randint(32, 126)) for _ in range(length))
+    totals = {}
+
+    def hook(stage, seconds):
+        total = totals.setdefault(stage, [0, 0.0])
+        total[0] += 1
+        total[1] += seconds
+
+    with FeistelCipher.instrumented(hook), redirect_stdout(io.StringIO()):
+        encryptedBlocks = FeistelCipher.encryption(text, 64, rounds, subkeys)
+        FeistelCipher.decryption(encryptedBlocks, rounds, subkeys)
+
+    return {stage: {'calls': calls, 'seconds': seconds, 'secondsPerCall': seconds / calls}
+            for stage, (calls, seconds) in totals.items()}
+
+
+def run():
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'keySchedule': benchmarkKeySchedule(),
+        'blockLatency': benchmarkBlockLatency(),
+        'throughput': benchmarkThroughput(),
+        'stages': benchmarkStages(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Feistel cipher and print the results as JSON.")
+    parser.add_argument('-o', '--output', help="write the JSON to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = json.dumps(run(), indent=2)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(results + '\n')
+    else:
+        print(results)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
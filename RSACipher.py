@@ -1,12 +1,134 @@
 __author__ = 'Andreas Hove'
 
+import mmap
+import os
 import random
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, wait
 
 BITS = ('0', '1')
 ASCII_BITS = 8
 
 '''######### MATHEMATICAL FUNCTIONS #########'''
-def findPrime(n):
+def small_primes(limit):
+    '''
+    Primes below limit, sieve of Eratosthenes.
+    '''
+    sieve = bytearray([1]) * limit
+    sieve[:2] = b'\x00\x00'
+    for i in range(2, int(limit**0.5) + 1):
+        if sieve[i]:
+            sieve[i*i::i] = bytes(len(range(i*i, limit, i)))
+    return [i for i in range(limit) if sieve[i]]
+
+SMALL_PRIMES = small_primes(2048)[1:]  # odd primes only, candidates are always odd
+
+class PrimeStats:
+    '''
+    Counters for findPrime(): odd candidates looked at, how many of them the sieve removed, how many went
+    through Miller-Rabin, the modular exponentiations that cost, and the primes found.
+    '''
+    __slots__ = ('candidates', 'sieved', 'tested', 'exponentiations', 'primes')
+
+    def __init__(self):
+        self.candidates = self.sieved = self.tested = self.exponentiations = self.primes = 0
+
+    def __repr__(self):
+        return "PrimeStats(candidates={}, sieved={}, tested={}, exponentiations={}, primes={})".format(
+            self.candidates, self.sieved, self.tested, self.exponentiations, self.primes)
+
+prime_stats = PrimeStats()
+
+def miller_rabin_rounds(bits):
+    '''
+    Miller-Rabin rounds for an error probability below 2**-100 on random candidates (FIPS 186-4, C.3).
+    '''
+    if bits >= 1536:
+        return 3
+    if bits >= 1024:
+        return 4
+    if bits >= 512:
+        return 7
+    return 40
+
+def miller_rabin(n, rounds=40, stats=None, rng=random):
+    '''
+    Miller-Rabin test with random bases: n is composite if it fails any round, otherwise a probable prime.
+    Unlike fermat(), Carmichael numbers are rejected.
+    '''
+    if n < 4:
+        return n in (2, 3)
+    if n % 2 == 0:
+        return False
+
+    d = n - 1
+    s = (d & -d).bit_length() - 1
+    d >>= s
+    context = modular_context(n)
+    for i in range(rounds):
+        x = context.pow(rng.randrange(2, n-1), d)
+        if stats is not None:
+            stats.exponentiations += 1
+        if x == 1 or x == n-1:
+            continue
+        for j in range(s-1):
+            x = x*x % n
+            if x == n-1:
+                break
+        else:
+            return False
+    return True
+
+def findPrime(n, rounds=None, stats=prime_stats, rng=random):
+    '''
+    Finds a probable prime of exactly n bits.
+    A random start with the top two bits set (so a product of two such primes has exactly 2n bits) and the
+    low bit set is picked, and the odd numbers in a window above it are sieved by the small primes. Only
+    the survivors get Miller-Rabin; if none passes, a new start is drawn. Pass a seeded random.Random as
+    rng to get the same prime every time.
+    '''
+    if n < 2:
+        raise ValueError("a prime needs at least 2 bits, got {}".format(n))
+    if rounds is None:
+        rounds = miller_rabin_rounds(n)
+
+    while True:
+        prime = search_window(n, rounds, stats, rng)
+        if prime is not None:
+            return prime
+
+def search_window(n, rounds, stats, rng):
+    '''
+    One window of findPrime(): returns the first probable prime in it, or None.
+    '''
+    window = max(2*n, 16)
+    start = rng.getrandbits(n) | (3 << (n-2)) | 1
+    sieve = bytearray([1]) * window  # sieve[i] is start + 2*i
+    for prime in SMALL_PRIMES:
+        if prime >= start:
+            break
+        first = (-start * ((prime + 1) // 2)) % prime  # i with start + 2*i = 0 mod prime
+        sieve[first::prime] = bytes(len(range(first, window, prime)))
+
+    for i in range(window):
+        candidate = start + 2*i
+        if candidate.bit_length() > n:
+            break
+        stats.candidates += 1
+        if not sieve[i]:
+            stats.sieved += 1
+            continue
+        stats.tested += 1
+        if miller_rabin(candidate, rounds, stats, rng):
+            stats.primes += 1
+            return candidate
+    return None
+
+def find_prime_fermat(n):
     '''
     Finds a number raised to power of n which is probably prime using the Fermat Method
     Discussed on page 2 in the report.
@@ -18,6 +140,31 @@ def findPrime(n):
             p = ran
     return p
 
+def benchmark_primes(keysizes=(1024, 2048, 4096), count=3):
+    '''
+    Times findPrime() against the original find_prime_fermat() for the two primes of each key size,
+    and prints how many candidates and exponentiations findPrime() needed.
+    '''
+    results = {}
+    for keysize in keysizes:
+        bits = keysize // 2
+        stats = PrimeStats()
+
+        start = time.perf_counter()
+        for i in range(count):
+            findPrime(bits, stats=stats)
+        sieved = (time.perf_counter() - start) / count
+
+        start = time.perf_counter()
+        for i in range(count):
+            find_prime_fermat(bits)
+        fermat_time = (time.perf_counter() - start) / count
+
+        results[keysize] = {'findPrime': sieved, 'fermat': fermat_time, 'stats': stats}
+        print("{:>5} bit keys: findPrime {:.3f} s, fermat {:.3f} s per prime, {}".format(
+            keysize, sieved, fermat_time, stats))
+    return results
+
 def fermat(n):
     '''
     Fermat Method used to verify if n is a probable prime.
@@ -39,12 +186,21 @@ def crt(c, p, q, d):
     dp = d % (p-1)
     dq = d % (q-1)
     qinv = modinv(q, p)
-    m1 = fast_exponentiation(c, dp, p)
-    m2 = fast_exponentiation(c, dq, q)
+    m1 = modular_context(p).pow(c, dp)
+    m2 = modular_context(q).pow(c, dq)
     h = qinv * (m1-m2) % p
     return m2 + h*q
 
 def fast_exponentiation(a,b,n):
+    '''
+    Modular exponentiation, a**b mod n.
+    Uses the built-in pow(). In benchmark_exponentiation() it is the fastest at 1024, 2048 and 4096 bits
+    and within about 10% of sliding_window_exponentiation() at 3072 bits, and for short exponents such
+    as e it is much faster than either Python loop. square_and_multiply() is the original version.
+    '''
+    return pow(a, b, n)
+
+def square_and_multiply(a,b,n):
     '''
     Left-to-Right binary exponentiation
     Code from: http://aditya.vaidya.info/blog/2014/06/27/modular-exponentiation-python/
@@ -58,93 +214,1145 @@ def fast_exponentiation(a,b,n):
         b >>= 1
     return x%n
 
+def window_size(bits):
+    '''
+    Window size for sliding-window exponentiation with an exponent of the given bit length,
+    picked to minimise the number of multiplications (squarings are the same for every size).
+    '''
+    for k, limit in ((1, 23), (3, 79), (4, 239), (5, 671)):
+        if bits <= limit:
+            return k
+    return 6
+
+def window_pow(a, b, one, multiply, k=None):
+    '''
+    Sliding-window exponentiation, a**b with the multiplication (including its reduction) passed in,
+    so the modular contexts below can use it in their own form.
+    The odd powers a, a**3, .., a**(2**k - 1) are computed first, then the exponent is read from the top
+    bit down: zero bits cost a squaring, and each window of up to k bits that ends in a 1 costs its
+    squarings plus one multiplication by a precomputed power.
+    '''
+    if k is None:
+        k = window_size(b.bit_length())
+
+    square = multiply(a, a)
+    odd_powers = [a]
+    for i in range((1 << (k-1)) - 1):
+        odd_powers.append(multiply(odd_powers[-1], square))
+
+    x = one
+    i = b.bit_length() - 1
+    while i >= 0:
+        if not (b >> i) & 1:
+            x = multiply(x, x)
+            i -= 1
+            continue
+
+        j = max(i - k + 1, 0)
+        while not (b >> j) & 1:  # the window has to end in a 1
+            j += 1
+        for _ in range(i - j + 1):
+            x = multiply(x, x)
+        x = multiply(x, odd_powers[((b >> j) & ((1 << (i - j + 1)) - 1)) >> 1])
+        i = j - 1
+
+    return x
+
+def sliding_window_exponentiation(a, b, n, k=None):
+    '''
+    Sliding-window exponentiation, a**b mod n, with window_pow() and plain % reductions.
+    '''
+    if n == 1:
+        return 0
+    return window_pow(a % n, b, 1, lambda x, y: x*y % n, k)
+
+class PowContext:
+    '''
+    Modular context using the built-in pow().
+    '''
+    __slots__ = ('n',)
+
+    def __init__(self, n):
+        self.n = n
+
+    def pow(self, a, b):
+        return pow(a, b, self.n)
+
+class MontgomeryContext:
+    '''
+    Modular context for an odd modulus n, in Montgomery form with R = 2**k > n. Numbers are kept as
+    a*R mod n, and a product is reduced with REDC: masks, shifts and one conditional subtraction,
+    no division. R**2 mod n (to convert into the form) and n' = -n**-1 mod R are computed here.
+    '''
+    __slots__ = ('n', 'k', 'mask', 'r2', 'nprime', 'one')
+
+    def __init__(self, n):
+        if n % 2 == 0:
+            raise ValueError("Montgomery reduction needs an odd modulus")
+        self.n = n
+        self.k = n.bit_length()
+        self.mask = (1 << self.k) - 1
+        self.r2 = (1 << (2*self.k)) % n
+        self.nprime = -pow(n, -1, 1 << self.k) & self.mask
+        self.one = (1 << self.k) % n
+
+    def reduce(self, t):
+        t = (t + ((t & self.mask) * self.nprime & self.mask) * self.n) >> self.k
+        return t - self.n if t >= self.n else t
+
+    def multiply(self, a, b):
+        return self.reduce(a*b)
+
+    def pow(self, a, b):
+        if self.n == 1:
+            return 0
+        x = window_pow(self.reduce(a % self.n * self.r2), b, self.one, self.multiply)
+        return self.reduce(x)
+
+class BarrettContext:
+    '''
+    Modular context with Barrett reduction: mu = 4**k // n is computed here, and a product below
+    n**2 is reduced with two multiplications, shifts and at most two subtractions.
+    '''
+    __slots__ = ('n', 'k', 'mu')
+
+    def __init__(self, n):
+        self.n = n
+        self.k = n.bit_length()
+        self.mu = (1 << (2*self.k)) // n
+
+    def reduce(self, x):
+        x -= ((x >> (self.k-1)) * self.mu >> (self.k+1)) * self.n
+        while x >= self.n:
+            x -= self.n
+        return x
+
+    def multiply(self, a, b):
+        return self.reduce(a*b)
+
+    def pow(self, a, b):
+        return window_pow(a % self.n, b, 1 % self.n, self.multiply)
+
+class SlidingWindowContext:
+    '''
+    Modular context using sliding_window_exponentiation().
+    '''
+    __slots__ = ('n',)
+
+    def __init__(self, n):
+        self.n = n
+
+    def pow(self, a, b):
+        return sliding_window_exponentiation(a, b, self.n)
+
+CONTEXTS = {'pow': PowContext, 'montgomery': MontgomeryContext, 'barrett': BarrettContext,
+            'sliding_window': SlidingWindowContext}
+
+# Fastest context by modulus size, as (largest modulus bits, name), from benchmark_contexts(). pow()
+# already does its reductions in C, and was fastest at every size from 64 to 4096 bits.
+FASTEST_CONTEXT = [(None, 'pow')]
+
+def modular_context(n):
+    '''
+    Returns the context for modulus n that FASTEST_CONTEXT lists for its size.
+    '''
+    bits = n.bit_length()
+    for limit, name in FASTEST_CONTEXT:
+        if limit is None or bits <= limit:
+            return CONTEXTS[name](n)
+
+def benchmark_contexts(sizes=(64, 256, 512, 1024, 2048, 4096), repeat=5, select=False):
+    '''
+    Times pow() on every context with a full-size exponent and odd modulus of each size. With select=True, FASTEST_CONTEXT is replaced by the fastest context
+    per size.
+    '''
+    results = {}
+    fastest = []
+    for bits in sizes:
+        n = random.getrandbits(bits) | (1 << (bits-1)) | 1
+        bases = [random.randrange(2, n) for i in range(repeat)]
+        b = random.getrandbits(bits) | (1 << (bits-1))
+        expected = [pow(a, b, n) for a in bases]
+
+        timings = {}
+        for name, context in CONTEXTS.items():
+            start = time.perf_counter()
+            context = context(n)
+            values = [context.pow(a, b) for a in bases]
+            timings[name] = (time.perf_counter() - start) / repeat
+            if values != expected:
+                raise AssertionError("{} gave a wrong result at {} bits".format(name, bits))
+
+        results[bits] = timings
+        best = min(CONTEXTS, key=timings.get)
+        fastest.append((bits, best))
+        print("{:>5} bits: ".format(bits) + ", ".join("{} {:.3f} ms".format(name, seconds*1e3)
+                                                     for name, seconds in timings.items())
+              + " -> fastest: {}".format(best))
+
+    if select:
+        FASTEST_CONTEXT[:] = fastest[:-1] + [(None, fastest[-1][1])]
+    return results
+
+def benchmark_exponentiation(sizes=(1024, 2048, 3072, 4096), repeat=5):
+    '''
+    Times square_and_multiply(), sliding_window_exponentiation() and the built-in pow() on a full-size
+    exponent and odd modulus of each size, and prints the time per exponentiation.
+    '''
+    implementations = (('square_and_multiply', square_and_multiply),
+                       ('sliding_window', sliding_window_exponentiation),
+                       ('pow', pow))
+    results = {}
+    for bits in sizes:
+        n = random.getrandbits(bits) | (1 << (bits-1)) | 1
+        bases = [random.randrange(2, n) for i in range(repeat)]
+        b = random.getrandbits(bits) | (1 << (bits-1))
+        expected = [pow(a, b, n) for a in bases]
+
+        for name, function in implementations:
+            start = time.perf_counter()
+            values = [function(a, b, n) for a in bases]
+            results[(bits, name)] = (time.perf_counter() - start) / repeat
+            if values != expected:
+                raise AssertionError("{} gave a wrong result at {} bits".format(name, bits))
+
+        fastest = min(implementations, key=lambda item: results[(bits, item[0])])[0]
+        print("{:>5} bits: ".format(bits) + ", ".join("{} {:.2f} ms".format(name, results[(bits, name)]*1e3)
+                                                     for name, function in implementations)
+              + " -> fastest: {}".format(fastest))
+    return results
+
 def egcd(a, b):
     '''
-    Extended Greatest Common Divider.
-    Code from: https://en.wikibooks.org/wiki/Algorithm_Implementation/Mathematics/Extended_Euclidean_algorithm
-    This code is part of the modinv() function, which is discussed on page 2 in the report.
+    Extended Greatest Common Divider: returns (g, x, y) with a*x + b*y = g = gcd(a, b).
+    Iterative version of the code from: https://en.wikibooks.org/wiki/Algorithm_Implementation/Mathematics/Extended_Euclidean_algorithm
+    which recursed once per division step and ran out of stack for numbers above ~2000 bits.
+    Used for the gcd checks in key generation; modinv() is discussed on page 2 in the report.
     '''
-    if a == 0:
-        return b, 0, 1
-    else:
-        g, y, x = egcd(b % a, a)
-        return g, x - (b // a) * y, y
+    x0, x1, y0, y1 = 1, 0, 0, 1
+    while b:
+        quotient, remainder = divmod(a, b)
+        a, b = b, remainder
+        x0, x1 = x1, x0 - quotient*x1
+        y0, y1 = y1, y0 - quotient*y1
+    if a < 0:
+        return -a, -x0, -y0
+    return a, x0, y0
 
 def modinv(a, m):
     '''
     Modular Inverse.
-    Code from: https://en.wikibooks.org/wiki/Algorithm_Implementation/Mathematics/Extended_Euclidean_algorithm
+    Uses the built-in pow(a, -1, m), which benchmark_inverses() measured at about twice the speed of
+    egcd() from 512 to 8192 bits. Raises ValueError if a has no inverse mod m.
     Discussed on page 2 in the report.
     '''
-    g, x, y = egcd(a, m)
-    if g != 1:
-        print("ERROR: Modular inverse does not exist. Following exception is now thrown.")
-        raise Exception('modular inverse does not exist')
-    else:
-        return x % m
+    try:
+        return pow(a, -1, m)
+    except ValueError:
+        raise ValueError("{} has no inverse mod {}".format(a, m)) from None
+
+def batch_modinv(values, m):
+    '''
+    Inverts all values mod m with one modinv() and 3(k-1) multiplications (Montgomery's trick): the
+    prefix products are inverted as a whole, then unwound from the back. Raises ValueError if any
+    value has no inverse mod m.
+    '''
+    if not values:
+        return []
+    prefix = [values[0] % m]
+    for value in values[1:]:
+        prefix.append(prefix[-1] * value % m)
+
+    inverse = modinv(prefix[-1], m)
+    result = [0] * len(values)
+    for i in range(len(values) - 1, 0, -1):
+        result[i] = inverse * prefix[i-1] % m
+        inverse = inverse * values[i] % m
+    result[0] = inverse
+    return result
+
+def benchmark_inverses(sizes=(512, 1024, 2048, 4096, 8192), count=100):
+    '''
+    Prints the time per inverse of `count` values modulo a prime-sized odd modulus of each size, with
+    egcd(), modinv() and batch_modinv().
+    '''
+    results = {}
+    for bits in sizes:
+        m = findPrime(bits) if bits <= 2048 else random.getrandbits(bits) | (1 << (bits-1)) | 1
+        values = []
+        while len(values) < count:
+            value = random.randrange(2, m)
+            if egcd(value, m)[0] == 1:
+                values.append(value)
+
+        timings = {}
+        for name, invert in (('egcd', lambda: [egcd(v, m)[1] % m for v in values]),
+                             ('modinv', lambda: [modinv(v, m) for v in values]),
+                             ('batch_modinv', lambda: batch_modinv(values, m))):
+            start = time.perf_counter()
+            inverses = invert()
+            timings[name] = (time.perf_counter() - start) / count
+            if any(v * inverse % m != 1 for v, inverse in zip(values, inverses)):
+                raise AssertionError("{} gave a wrong inverse at {} bits".format(name, bits))
+
+        results[bits] = timings
+        print("{:>5} bits: ".format(bits) + ", ".join("{} {:.1f} us".format(name, seconds*1e6)
+                                                     for name, seconds in timings.items()))
+    return results
+
+'''######### KEYS #########'''
+def crt_decrypt_many(key, blocks):
+    '''
+    Decrypts blocks with the CRT parameters of key (a PrivateKey or StoredKey) and its mod_p and mod_q
+    contexts.
+    '''
+    p, q, dp, dq, qinv = key.p, key.q, key.dp, key.dq, key.qinv
+    mod_p, mod_q = key.mod_p.pow, key.mod_q.pow
+    result = []
+    for c in blocks:
+        m2 = mod_q(c, dq)
+        result.append(m2 + qinv * (mod_p(c, dp) - m2) % p * q)
+    return result
+
+class PrivateKey:
+    '''
+    RSA private key. The CRT parameters dp, dq and qinv are computed once here, so decrypting a block
+    only costs the two half-size exponentiations mod p and mod q.
+    '''
+    __slots__ = ('n', 'e', 'd', 'p', 'q', 'dp', 'dq', 'qinv', 'mod_n', 'mod_p', 'mod_q')
+
+    def __init__(self, p, q, e=65537, d=None):
+        self.p = p
+        self.q = q
+        self.n = p*q
+        self.e = e
+        self.d = d if d is not None else modinv(e, (p-1)*(q-1))
+        self.dp = self.d % (p-1)
+        self.dq = self.d % (q-1)
+        self.qinv = modinv(q, p)
+        self.mod_n = modular_context(self.n)
+        self.mod_p = modular_context(p)
+        self.mod_q = modular_context(q)
+
+    def decrypt(self, c):
+        m1 = self.mod_p.pow(c, self.dp)
+        m2 = self.mod_q.pow(c, self.dq)
+        h = self.qinv * (m1-m2) % self.p
+        return m2 + h*self.q
+
+    def decrypt_many(self, blocks):
+        return crt_decrypt_many(self, blocks)
+
+    def encrypt(self, m):
+        return self.mod_n.pow(m, self.e)
+
+    def blinding_factors(self, count, rng=random):
+        '''
+        Returns count pairs (r**e mod n, r**-1 mod n) for random r. Decrypting c * r**e mod n and
+        multiplying by r**-1 gives the plaintext of c, without the exponentiation ever seeing c itself.
+        The inverses are computed together with batch_modinv().
+        '''
+        factors = [rng.randrange(2, self.n - 1) for _ in range(count)]
+        return list(zip((self.encrypt(r) for r in factors), batch_modinv(factors, self.n)))
+
+def generate_key(keysize, e=65537):
+    '''
+    Generates a private key with a modulus of about keysize bits, drawing new primes until
+    e is invertible mod (p-1)*(q-1).
+    '''
+    while True:
+        p = findPrime(keysize // 2)
+        q = findPrime(keysize // 2)
+        if p != q and egcd(e, (p-1)*(q-1))[0] == 1:
+            return PrivateKey(p, q, e)
+
+class MultiPrimeKey:
+    '''
+    RSA private key with a modulus of k primes. Decryption does one exponentiation mod each prime,
+    with d reduced mod prime-1, and recombines the results with Garner's algorithm. For each prime after
+    the first, the product of the primes before it and that product's inverse are computed here.
+    '''
+    __slots__ = ('n', 'e', 'd', 'primes', 'exponents', 'products', 'coefficients')
+
+    def __init__(self, primes, e=65537):
+        self.primes = tuple(primes)
+        self.e = e
+        self.n = 1
+        phi = 1
+        for prime in self.primes:
+            self.n *= prime
+            phi *= prime - 1
+        self.d = modinv(e, phi)
+        self.exponents = tuple(self.d % (prime-1) for prime in self.primes)
+
+        self.products = []
+        self.coefficients = []
+        product = self.primes[0]
+        for prime in self.primes[1:]:
+            self.products.append(product)
+            self.coefficients.append(modinv(product % prime, prime))
+            product *= prime
+
+    def decrypt(self, c):
+        primes, exponents = self.primes, self.exponents
+        m = fast_exponentiation(c, exponents[0], primes[0])
+        for i in range(1, len(primes)):
+            prime = primes[i]
+            mi = fast_exponentiation(c, exponents[i], prime)
+            m += (mi - m) * self.coefficients[i-1] % prime * self.products[i-1]
+        return m
+
+    def decrypt_many(self, blocks):
+        return [self.decrypt(c) for c in blocks]
+
+    def encrypt(self, m):
+        return fast_exponentiation(m, self.e, self.n)
+
+def generate_multiprime_key(keysize, count=3, e=65537):
+    '''
+    Generates a MultiPrimeKey of `count` distinct primes with a modulus of exactly keysize bits.
+    The prime sizes add up to keysize, but with more than two primes the top two bits of each are not
+    enough to guarantee the product's length, so primes are drawn again until it is right.
+    '''
+    sizes = [keysize // count + (i < keysize % count) for i in range(count)]
+    while True:
+        primes = [findPrime(size) for size in sizes]
+        n = 1
+        for prime in primes:
+            n *= prime
+        if (n.bit_length() == keysize and len(set(primes)) == count
+                and all(egcd(e, prime-1)[0] == 1 for prime in primes)):
+            return MultiPrimeKey(primes, e)
+
+def benchmark_multiprime(keysizes=(2048, 3072, 4096), counts=(2, 3, 4), repeat=20):
+    '''
+    Prints the decryption time with 2, 3 and 4 primes at each key size, next to the two-prime
+    PrivateKey.
+    '''
+    results = {}
+    for keysize in keysizes:
+        two = generate_key(keysize)
+        blocks = [random.randrange(2, two.n) for _ in range(repeat)]
+        start = time.perf_counter()
+        two.decrypt_many(blocks)
+        base = (time.perf_counter() - start) / repeat
+        print("{:>5} bits, PrivateKey: {:.3f} ms".format(keysize, base * 1e3))
+
+        for count in counts:
+            key = generate_multiprime_key(keysize, count)
+            blocks = [random.randrange(2, key.n) for _ in range(repeat)]
+            start = time.perf_counter()
+            plaintexts = key.decrypt_many(blocks)
+            results[(keysize, count)] = (time.perf_counter() - start) / repeat
+            assert [key.encrypt(m) for m in plaintexts] == blocks
+            print("{:>5} bits, {} primes:   {:.3f} ms, {:.2f}x".format(
+                keysize, count, results[(keysize, count)] * 1e3, base / results[(keysize, count)]))
+    return results
+
+BATCH_EXPONENTS = (3, 5, 7, 11, 13, 17, 19, 23)
+
+class BatchKey:
+    '''
+    RSA key whose modulus is shared by several small, distinct public exponents, so ciphertexts
+    encrypted under different exponents can be decrypted together with decrypt_batch() (Fiat's batch
+    RSA). The private key for each exponent is a PrivateKey, used for single ciphertexts.
+    '''
+    __slots__ = ('n', 'p', 'q', 'exponents', 'keys', 'roots')
+
+    def __init__(self, p, q, exponents=BATCH_EXPONENTS):
+        if len(set(exponents)) != len(exponents):
+            raise ValueError("batch exponents must be distinct")
+        self.p = p
+        self.q = q
+        self.n = p*q
+        self.exponents = tuple(exponents)
+        self.keys = {e: PrivateKey(p, q, e) for e in self.exponents}
+        self.roots = {}  # product of a batch's exponents -> PrivateKey for that product
+
+    def encrypt(self, m, e):
+        return fast_exponentiation(m, e, self.n)
+
+    def decrypt(self, c, e):
+        return self.keys[e].decrypt(c)
+
+    def decrypt_batch(self, ciphertexts):
+        '''
+        Decrypts a list of (e, c) pairs and returns the plaintexts in the same order.
+        The pairs are grouped into batches with distinct exponents. Each batch costs one full-size
+        exponentiation, the e-th roots of the single ciphertexts are then split out of it with
+        exponentiations by the small exponents and modular inverses. Pairs that end up alone in a batch,
+        or batches with a ciphertext that has no inverse mod n, are decrypted one at a time.
+        '''
+        batches = []
+        for index, (e, c) in enumerate(ciphertexts):
+            for batch in batches:
+                if e not in batch:
+                    batch[e] = (index, c)
+                    break
+            else:
+                batches.append({e: (index, c)})
+
+        result = [None] * len(ciphertexts)
+        for batch in batches:
+            items = list(batch.items())
+            if len(items) > 1:
+                try:
+                    plaintexts = self.fiat(items)
+                except ValueError:
+                    plaintexts = None
+                if plaintexts is not None:
+                    for (e, (index, c)), m in zip(items, plaintexts):
+                        result[index] = m
+                    continue
+            for e, (index, c) in items:
+                result[index] = self.decrypt(c, e)
+        return result
+
+    def fiat(self, items):
+        tree = self.percolate_up(items)
+        product = tree[0]
+        if product not in self.roots:
+            self.roots[product] = PrivateKey(self.p, self.q, product)
+        plaintexts = []
+        self.percolate_down(tree, self.roots[product].decrypt(tree[1]), plaintexts)
+        return plaintexts
+
+    def percolate_up(self, items):
+        # a node is (product of exponents, value, left, right); a leaf's value is its ciphertext
+        if len(items) == 1:
+            e, (index, c) = items[0]
+            return (e, c % self.n, None, None)
+        middle = len(items) // 2
+        left = self.percolate_up(items[:middle])
+        right = self.percolate_up(items[middle:])
+        value = fast_exponentiation(left[1], right[0], self.n) * fast_exponentiation(right[1], left[0], self.n)
+        return (left[0] * right[0], value % self.n, left, right)
+
+    def percolate_down(self, node, root, plaintexts):
+        # root is the node's value to the power 1/(product of its exponents)
+        e, value, left, right = node
+        if left is None:
+            plaintexts.append(root)
+            return
+        n = self.n
+        x = left[0] * modinv(left[0], right[0])  # x = 0 mod e_left, x = 1 mod e_right
+        divisor = fast_exponentiation(left[1], x // left[0], n) * fast_exponentiation(right[1], (x-1) // right[0], n)
+        right_root = fast_exponentiation(root, x, n) * modinv(divisor, n) % n
+        left_root = root * modinv(right_root, n) % n
+        self.percolate_down(left, left_root, plaintexts)
+        self.percolate_down(right, right_root, plaintexts)
+
+def generate_batch_key(keysize, exponents=BATCH_EXPONENTS):
+    '''
+    Generates a BatchKey with a modulus of about keysize bits, keeping only primes p where every
+    exponent is invertible mod p-1.
+    '''
+    def suitable_prime():
+        while True:
+            prime = findPrime(keysize // 2)
+            if all((prime - 1) % e for e in exponents):
+                return prime
+
+    while True:
+        p = suitable_prime()
+        q = suitable_prime()
+        if p != q:
+            return BatchKey(p, q, exponents)
+
+def benchmark_batch(keysize=2048, sizes=(1, 2, 4, 8), messages=64):
+    '''
+    Prints the decryption time per message with decrypt_batch() for each batch size, next to
+    decrypting the same messages one at a time.
+    '''
+    key = generate_batch_key(keysize, BATCH_EXPONENTS[:max(sizes)])
+    results = {}
+    for size in sizes:
+        exponents = key.exponents[:size]
+        pairs = [(exponents[i % size], key.encrypt(random.randrange(2, key.n), exponents[i % size]))
+                 for i in range(messages)]
+
+        start = time.perf_counter()
+        single = [key.decrypt(c, e) for e, c in pairs]
+        single_time = (time.perf_counter() - start) / messages
+
+        start = time.perf_counter()
+        batched = key.decrypt_batch(pairs)
+        batch_time = (time.perf_counter() - start) / messages
+
+        assert batched == single
+        results[size] = (single_time, batch_time)
+        print("batch size {:>2}: {:.3f} ms per message, {:.3f} ms one at a time, {:.2f}x".format(
+            size, batch_time * 1e3, single_time * 1e3, single_time / batch_time))
+    return results
+
+def prime_task(n, stream, index, rounds):
+    '''
+    Searches window number index of a prime search stream, seeded by the stream name and the index
+    so the outcome does not depend on which process runs it. Returns a prime or None.
+    '''
+    return search_window(n, rounds, PrimeStats(), random.Random("{}:{}".format(stream, index)))
+
+def search_primes(n, streams, workers=None, rounds=None):
+    '''
+    Finds one n-bit prime for each stream name, all at the same time.
+    Every stream is a numbered sequence of prime_task() windows, and its prime is the one in the
+    lowest-numbered window that has one. Windows of all streams are spread over a process pool; when a
+    stream's prime is settled, its queued windows are cancelled and the freed workers move on to the
+    streams still searching. The result is the same for any number of workers.
+    '''
+    if rounds is None:
+        rounds = miller_rabin_rounds(n)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    found = {}
+    if workers <= 1:
+        for stream in streams:
+            index = 0
+            while stream not in found:
+                prime = prime_task(n, stream, index, rounds)
+                if prime is not None:
+                    found[stream] = prime
+                index += 1
+        return [found[stream] for stream in streams]
+
+    next_index = dict.fromkeys(streams, 0)
+    lowest = dict.fromkeys(streams, 0)  # lowest window whose result is still needed
+    results = {stream: {} for stream in streams}
+    pending = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        def submit(stream):
+            future = executor.submit(prime_task, n, stream, next_index[stream], rounds)
+            pending[future] = (stream, next_index[stream])
+            next_index[stream] += 1
+
+        while len(found) < len(streams):
+            searching = [stream for stream in streams if stream not in found]
+            while len(pending) < workers:
+                submit(min(searching, key=lambda stream: next_index[stream] - lowest[stream]))
+
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stream, index = pending.pop(future)
+                if stream not in found:
+                    results[stream][index] = future.result()
+
+            for stream in searching:
+                while lowest[stream] in results[stream]:
+                    prime = results[stream].pop(lowest[stream])
+                    if prime is not None:
+                        found[stream] = prime
+                        for future, (owner, index) in list(pending.items()):
+                            if owner == stream and future.cancel():
+                                del pending[future]
+                        break
+                    lowest[stream] += 1
+
+        executor.shutdown(cancel_futures=True)
+
+    return [found[stream] for stream in streams]
+
+def generate_key_parallel(keysize, workers=None, seed=None, e=65537, rounds=None):
+    '''
+    Like generate_key(), but p and q are searched for at the same time with search_primes(), each over
+    several windows in parallel. The same seed gives the same key whatever the number of workers.
+    Without a seed, 256 bits are taken from os.urandom(); explicit seeds are meant for tests only.
+    '''
+    if seed is None:
+        # random's Mersenne Twister is predictable and 64 bits could be searched, so the key would be too
+        seed = int.from_bytes(os.urandom(32), 'big')
+
+    attempt = 0
+    while True:
+        streams = ["{}:{}:p".format(seed, attempt), "{}:{}:q".format(seed, attempt)]
+        p, q = search_primes(keysize // 2, streams, workers, rounds)
+        if p != q and egcd(e, (p-1)*(q-1))[0] == 1:
+            return PrivateKey(p, q, e)
+        attempt += 1
+
+def benchmark_keygen(keysizes=(2048, 4096), workers=None, seeds=3):
+    '''
+    Prints the wall-clock time of generate_key_parallel() for 1 up to `workers` processes, averaged
+    over the same seeds for every worker count.
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    results = {}
+    for keysize in keysizes:
+        for count in range(1, workers + 1):
+            start = time.perf_counter()
+            keys = [generate_key_parallel(keysize, count, seed) for seed in range(seeds)]
+            results[(keysize, count)] = (time.perf_counter() - start) / seeds
+            print("{:>5} bits, {:>2} workers: {:.3f} s per key, speedup {:.2f}x".format(
+                keysize, count, results[(keysize, count)], results[(keysize, 1)] / results[(keysize, count)]))
+    return results
+
+class KeyPool:
+    '''
+    Keeps up to `depth` pre-generated keys of keysize bits. A process pool generates new keys in the
+    background whenever a key is taken, so get_keypair() returns at once while there is stock and only
+    waits for findPrime() when demand outruns the workers. A failed job is handed to the next waiting
+    get_keypair() call as a RuntimeError, and generation is restarted.
+    '''
+
+    def __init__(self, keysize=1024, depth=8, workers=None, e=65537):
+        self.keysize = keysize
+        self.depth = depth
+        self.workers = workers
+        self.e = e
+        self.keys = deque()
+        self.condition = threading.Condition()
+        self.inflight = 0
+        self.closed = False
+        self.error = None
+        self.started = time.perf_counter()
+        self.generated = 0
+        self.served = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        with self.condition:
+            self.refill()
+
+    def refill(self):
+        # called with the condition held
+        while not self.closed and len(self.keys) + self.inflight < self.depth:
+            try:
+                future = self.executor.submit(generate_key, self.keysize, self.e)
+            except BrokenExecutor as error:
+                self.error = error
+                self.condition.notify_all()
+                return
+            self.inflight += 1
+            future.add_done_callback(self.generated_key)
+
+    def generated_key(self, future):
+        with self.condition:
+            self.inflight -= 1
+            # results arriving after close() are dropped, the pool no longer hands out keys
+            if self.closed or future.cancelled():
+                return
+            if future.exception() is not None:
+                self.error = future.exception()
+                self.condition.notify_all()
+                return
+            self.keys.append(future.result())
+            self.generated += 1
+            self.condition.notify()
+
+    def get_keypair(self, timeout=None):
+        '''
+        Takes a key out of the pool, waiting at most timeout seconds for one (forever if None).
+        Raises TimeoutError when none arrives in time, and RuntimeError once the pool is closed or when
+        key generation failed while the pool was empty.
+        '''
+        start = time.perf_counter()
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.keys or self.closed or self.error, timeout):
+                raise TimeoutError("no key generated within {} seconds".format(timeout))
+            if self.closed:
+                raise RuntimeError("key pool is closed")
+            if not self.keys:
+                error, self.error = self.error, None
+                if isinstance(error, BrokenExecutor):
+                    # a dead worker breaks the whole process pool, start a fresh one
+                    self.executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                self.refill()
+                raise RuntimeError("key generation failed") from error
+            key = self.keys.popleft()
+            self.refill()
+
+            waited = time.perf_counter() - start
+            self.served += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if waited > 0.001:
+                self.waits += 1
+        return key
+
+    def metrics(self):
+        with self.condition:
+            elapsed = time.perf_counter() - self.started
+            return {'depth': len(self.keys), 'inflight': self.inflight, 'generated': self.generated,
+                    'refill_rate': self.generated / elapsed, 'served': self.served, 'waits': self.waits,
+                    'wait_mean': self.wait_total / self.served if self.served else 0.0,
+                    'wait_max': self.wait_max}
+
+    def close(self):
+        '''
+        Stops the background generation. Keys still being generated are cancelled or dropped, and
+        waiting get_keypair() calls raise RuntimeError.
+        '''
+        with self.condition:
+            self.closed = True
+            self.keys.clear()
+            self.condition.notify_all()
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def benchmark_pool(keysize=1024, depth=8, bursts=5, burst=4, pause=1.0, workers=None):
+    '''
+    Takes `bursts` bursts of `burst` keys with `pause` seconds between them, once straight from
+    generate_key() and once from a filled KeyPool, and prints the p50/p99/max latency of both.
+    '''
+    def percentiles(latencies):
+        latencies = sorted(latencies)
+        return (latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)],
+                latencies[-1])
+
+    def run(get):
+        latencies = []
+        for _ in range(bursts):
+            for _ in range(burst):
+                start = time.perf_counter()
+                get()
+                latencies.append(time.perf_counter() - start)
+            time.sleep(pause)
+        return percentiles(latencies)
+
+    results = {'direct': run(lambda: generate_key(keysize))}
+    with KeyPool(keysize, depth, workers) as pool:
+        while pool.metrics()['depth'] < depth:
+            time.sleep(0.05)
+        results['pool'] = run(pool.get_keypair)
+        print(pool.metrics())
+
+    for name, (p50, p99, worst) in results.items():
+        print("{:>6}: p50 {:.4f} s, p99 {:.4f} s, max {:.4f} s".format(name, p50, p99, worst))
+    return results
+
+'''######### BLOCK PACKING #########'''
+def block_bytes(n):
+    '''
+    Number of whole bytes that always make an integer smaller than the modulus n.
+    '''
+    size = (n.bit_length() - 1) // 8
+    if size < 1:
+        raise ValueError("modulus of {} bits is too small to hold a byte".format(n.bit_length()))
+    return size
+
+def pack_blocks(data, n):
+    '''
+    Splits bytes into integers smaller than n, each taking block_bytes(n) bytes of the data.
+    The data is first padded with 0x80 and then zeros up to a whole number of blocks, so the length is
+    recovered exactly by unpack_blocks(), whatever the block size.
+    '''
+    size = block_bytes(n)
+    data = bytes(data) + b'\x80'
+    data += bytes(-len(data) % size)
+    return [int.from_bytes(data[i:i+size], 'big') for i in range(0, len(data), size)]
+
+def unpack_blocks(blocks, n):
+    '''
+    Inverse of pack_blocks(): joins the integers back into bytes and removes the padding.
+    '''
+    size = block_bytes(n)
+    for block in blocks:
+        if block < 0 or block >> (8*size):
+            raise ValueError("invalid block")
+    data = b''.join(block.to_bytes(size, 'big') for block in blocks).rstrip(b'\x00')
+    if not data.endswith(b'\x80'):
+        raise ValueError("invalid padding")
+    return data[:-1]
+
+def encrypt_bytes(data, e, n):
+    '''
+    Encrypts bytes with the exponent e and modulus n, returns the list of encrypted blocks.
+    '''
+    context = modular_context(n)
+    return [context.pow(m, e) for m in pack_blocks(data, n)]
+
+def decrypt_bytes(blocks, key):
+    '''
+    Decrypts the blocks from encrypt_bytes() with a PrivateKey, returns the bytes.
+    '''
+    return unpack_blocks(key.decrypt_many(blocks), key.n)
+
+'''######### KEYSTORE #########'''
+# A keystore file is a header, the key records and an index:
+#
+#   header   magic b'RSAK', version, number of keys, offset of the index
+#   record   eight 4-byte lengths, then n, e, d, p, q, dp, dq, qinv as big-endian bytes of those lengths
+#   index    per key: the offset of its record and the bit length of n
+#
+# save_keys() appends by writing a new file next to the store: the records of the current index, the new
+# records and a complete new index, and only replaces the store with it once it is on disk. An interrupted
+# append leaves the store as it was, and no old index or unreferenced record is ever carried over.
+# KeyStores opened before the replace keep reading the old file.
+KEYSTORE_MAGIC = b'RSAK'
+KEYSTORE_VERSION = 1
+KEYSTORE_HEADER = struct.Struct('>4sHxxIQ')
+KEYSTORE_INDEX = struct.Struct('>QI')
+KEY_FIELDS = ('n', 'e', 'd', 'p', 'q', 'dp', 'dq', 'qinv')
+KEY_RECORD = struct.Struct('>' + 'I' * len(KEY_FIELDS))
+
+class LazyField:
+    '''
+    Attribute of a StoredKey that is converted from its bytes in the store on first access.
+    '''
+    def __init__(self, index):
+        self.index = index
+
+    def __get__(self, key, owner=None):
+        if key is None:
+            return self
+        value = key.values[self.index]
+        if value is None:
+            start, end = key.spans[self.index]
+            value = key.values[self.index] = int.from_bytes(key.buffer[start:end], 'big')
+        return value
+
+class StoredKey:
+    '''
+    Key in a KeyStore. It reads only the record's lengths when it is fetched; every field becomes an
+    int the first time it is used, so encrypting never touches d, p, q or the CRT parameters.
+    Decrypts like a PrivateKey, with the contexts for p and q made on first use and kept.
+    '''
+    __slots__ = ('buffer', 'spans', 'values', 'contexts')
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.spans = []
+        start = offset + KEY_RECORD.size
+        for length in KEY_RECORD.unpack_from(buffer, offset):
+            self.spans.append((start, start + length))
+            start += length
+        self.values = [None] * len(KEY_FIELDS)
+        self.contexts = None  # modular contexts for p and q, made on the first decryption
+
+    def decrypt(self, c):
+        return self.decrypt_many([c])[0]
+
+    @property
+    def mod_p(self):
+        if self.contexts is None:
+            self.contexts = (modular_context(self.p), modular_context(self.q))
+        return self.contexts[0]
+
+    @property
+    def mod_q(self):
+        if self.contexts is None:
+            self.contexts = (modular_context(self.p), modular_context(self.q))
+        return self.contexts[1]
+
+    def decrypt_many(self, blocks):
+        return crt_decrypt_many(self, blocks)
+
+    def encrypt(self, m):
+        return fast_exponentiation(m, self.e, self.n)
+
+    def private_key(self):
+        '''
+        Converts to a PrivateKey (this materializes every field).
+        '''
+        return PrivateKey(self.p, self.q, self.e, self.d)
+
+for index, name in enumerate(KEY_FIELDS):
+    setattr(StoredKey, name, LazyField(index))
+
+class KeyStore:
+    '''
+    Read-only view of a keystore file written by save_keys(). The file is memory-mapped, so opening
+    it reads only the header, and store[i] finds key i through the index without reading other keys.
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError("{} is not a keystore".format(path))
+
+        if len(self.buffer) < KEYSTORE_HEADER.size:
+            self.close()
+            raise ValueError("{} is not a keystore".format(path))
+        magic, version, self.count, self.index = KEYSTORE_HEADER.unpack_from(self.buffer)
+        if magic != KEYSTORE_MAGIC or version != KEYSTORE_VERSION:
+            self.close()
+            raise ValueError("{} is not a version {} keystore".format(path, KEYSTORE_VERSION))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not -self.count <= i < self.count:
+            raise IndexError("key {} is not in a store of {} keys".format(i, self.count))
+        offset, bits = KEYSTORE_INDEX.unpack_from(self.buffer, self.index + (i % self.count) * KEYSTORE_INDEX.size)
+        return StoredKey(self.buffer, offset)
+
+    def keysizes(self):
+        '''
+        Bit length of every key's modulus, read from the index only.
+        '''
+        end = self.index + self.count * KEYSTORE_INDEX.size
+        return [bits for offset, bits in KEYSTORE_INDEX.iter_unpack(self.buffer[self.index:end])]
+
+    def find(self, keysize):
+        '''
+        Returns the last key with a modulus of keysize bits, or None.
+        '''
+        sizes = self.keysizes()
+        for i in range(len(sizes) - 1, -1, -1):
+            if sizes[i] == keysize:
+                return self[i]
+        return None
+
+    def close(self):
+        # keys fetched from the store can no longer be read after this
+        if getattr(self, 'buffer', None) is not None:
+            self.buffer.close()
+            self.buffer = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def save_keys(path, keys):
+    '''
+    Appends keys (PrivateKey or anything with the KEY_FIELDS attributes) to the keystore at path,
+    creating it if needed. Returns their numbers in the store.
+    '''
+    temp = path + '.tmp'
+    try:
+        with open(temp, 'wb') as store:
+            entries = []
+            end = KEYSTORE_HEADER.size
+            store.write(bytes(end))
+
+            if os.path.exists(path):
+                with open(path, 'rb') as old:
+                    header = old.read(KEYSTORE_HEADER.size)
+                    if len(header) < KEYSTORE_HEADER.size:
+                        raise ValueError("{} is not a keystore".format(path))
+                    magic, version, count, index = KEYSTORE_HEADER.unpack(header)
+                    if magic != KEYSTORE_MAGIC or version != KEYSTORE_VERSION:
+                        raise ValueError("{} is not a version {} keystore".format(path, KEYSTORE_VERSION))
+                    old.seek(index)
+                    # only the records the index points at are copied, so nothing dead is carried over
+                    for offset, bits in KEYSTORE_INDEX.iter_unpack(old.read(count * KEYSTORE_INDEX.size)):
+                        old.seek(offset)
+                        lengths = old.read(KEY_RECORD.size)
+                        record = lengths + old.read(sum(KEY_RECORD.unpack(lengths)))
+                        entries.append((end, bits))
+                        store.write(record)
+                        end += len(record)
+
+            first = len(entries)
+            for key in keys:
+                fields = [getattr(key, name) for name in KEY_FIELDS]
+                data = [field.to_bytes((field.bit_length() + 7) // 8, 'big') for field in fields]
+                entries.append((end, key.n.bit_length()))
+                record = KEY_RECORD.pack(*map(len, data)) + b''.join(data)
+                store.write(record)
+                end += len(record)
+
+            store.write(b''.join(KEYSTORE_INDEX.pack(*entry) for entry in entries))
+            store.seek(0)
+            store.write(KEYSTORE_HEADER.pack(KEYSTORE_MAGIC, KEYSTORE_VERSION, len(entries), end))
+            store.flush()
+            os.fsync(store.fileno())
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+    # make the rename itself durable (directories can only be opened for this on POSIX)
+    if hasattr(os, 'O_DIRECTORY'):
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+    return list(range(first, len(entries)))
+
+def benchmark_keystore(path, count=2000, keysize=1024, lookups=1000):
+    '''
+    Writes a store of `count` keys (one generated key, repeated) and times opening it and fetching
+    and decrypting with a random key, next to generating a key.
+    '''
+    start = time.perf_counter()
+    key = generate_key(keysize)
+    generate_time = time.perf_counter() - start
+
+    if os.path.exists(path):
+        os.remove(path)
+    save_keys(path, [key] * count)
+
+    start = time.perf_counter()
+    with KeyStore(path) as store:
+        open_time = time.perf_counter() - start
+        c = key.encrypt(12345)
+        start = time.perf_counter()
+        for i in range(lookups):
+            stored = store[random.randrange(count)]
+            stored.n
+        fetch_time = (time.perf_counter() - start) / lookups
+        start = time.perf_counter()
+        assert store[random.randrange(count)].decrypt(c) == 12345
+        decrypt_time = time.perf_counter() - start
+
+    print("{} keys of {} bits, {} bytes: open {:.1f} us, fetch {:.1f} us, first decrypt {:.2f} ms, "
+          "generate_key {:.1f} ms".format(count, keysize, os.path.getsize(path), open_time*1e6, fetch_time*1e6,
+                                           decrypt_time*1e3, generate_time*1e3))
+    return {'open': open_time, 'fetch': fetch_time, 'decrypt': decrypt_time, 'generate': generate_time}
 
 '''######### MAIN METHOD #########'''
-def main():
+def main(keystore=None):
     '''
-    main method for this script.
+    main method for this script. With a keystore path, a stored key of the chosen size is reused,
+    and a newly generated key is saved there.
     Discussed on page 1 in the report.
     '''
     print("###########")
     print("# # RSA # #")
     print("###########")
-    print("\nPlease type a plaintext to encrypt (minimum 8 characters)")
+    print("\nPlease type a plaintext to encrypt")
     plaintext = input("Plaintext: ")
     print("\nEncrypt using private key? (default usage is the public key)")
     whichKeyAnswer = input("(y/n): ").lower()
     print("\nWhich key size would you like to use?")
     keysize = input("Key size: ")
     keysize = int(keysize)
-    keysize //= 2
-
-    e = 65537
-    print("\nGenerating primes ..")
-    p = findPrime(keysize)
-    q = findPrime(keysize)
 
-    n = p*q
-    phi = (p-1)*(q-1)
-    d = modinv(e, phi)
+    key = None
+    if keystore is not None and os.path.exists(keystore):
+        with KeyStore(keystore) as store:
+            stored = store.find(keysize)
+            if stored is not None:
+                print("\nUsing stored key from {} ..".format(keystore))
+                key = stored.private_key()
+    if key is None:
+        print("\nGenerating primes ..")
+        key = generate_key(keysize)
+        if keystore is not None:
+            save_keys(keystore, [key])
+    e, p, q, d, n = key.e, key.p, key.q, key.d, key.n
     encKey = e
-    decKey = d
 
     print("\nEncryption parameters: \n"
          " - e: {}\n - p: {}\n - q: {}\n - d: {}".format(e, p, q, d))
     if whichKeyAnswer == "y":
         print(" - encrypting using private key .. ")
         encKey = d
-        decKey = e
+        key = PrivateKey(p, q, e=d, d=e)  # decrypts with e
     else: print(" - encrypting using public key .. ")
 
-    bits = string_to_bits(plaintext)
-    blocks = []
-    blocksize = 64
-    for b in range((len(bits) // blocksize)):  # split blocks into block size
-        block = bits[b*blocksize:(b+1)*blocksize]
-        blocks.append(block)
-
-    if (len(bits) % blocksize) != 0:
-        length = len(bits)  # get length of block
-        lastblock = bits[(b+1)*blocksize:length]  # create block of the actual size (less than block size)
-        createlast = []
-        emptyblock = [0]*(blocksize - len(lastblock))  # create block of leading zeroes
-
-        for i in emptyblock:
-            createlast.append(emptyblock[i])
-        for bit in lastblock:
-            createlast.append(bit)  # add the bits of the last block to the block with leading zeroes
-
-        blocks.append(createlast)
     print("\nEncrypted integers: ", end="")
-    for ch in blocks:
-        string = bit_list_to_string(ch)
-        integer = int(string,2)
-        #enc = integer**encKey % n
-        enc = fast_exponentiation(integer, encKey,n)
+    for enc in encrypt_bytes(plaintext.encode('utf-8'), encKey, n):
         print("{} ".format(enc), end="")
     print("\n\nTo decrypt, please input the enciphered integers")
     encipherbits = input("\nEnciphered integers: ")
@@ -153,18 +1361,15 @@ def main():
     if whichKeyAnswer == "y": print("\nDecrypting using public key .. ")
     else: print("\nDecrypting using private key .. ")
 
-    decryptedBlocks = []
-    for bl in encipherbits:
-        dec = crt(int(bl),p,q,decKey)
-        bits = convert_int_to_bits(dec)
-        padded_bits = pad_bits(bits,len(bits) + (ASCII_BITS - (len(bits) % ASCII_BITS)))
-        result = bits_to_string(padded_bits)
-        decryptedBlocks.append(result)
     print("Decrypted message: ", end="")
-    try: print(''.join(decryptedBlocks))
-    except UnicodeEncodeError: print("Error: error during decryption.")
+    try:
+        decrypted = decrypt_bytes([int(bl) for bl in encipherbits if bl], key).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        print("Error: error during decryption.")
+        return None
+    print(decrypted)
 
-    return ''.join(decryptedBlocks)
+    return decrypted
 
 '''######### HELPER FUNCTIONS #########'''
 def string_to_bits(string):
@@ -226,13 +1431,7 @@ def convert_int_to_bits(n):
     converts an integer to bit array. Original code from: https://gist.github.com/barrysteyn/4184435
     Discussed on page 3 in the report.
     """
-    result = []
-    if n == 0:
-        return [0]
-    while n > 0:
-        result = [(n % 2)] + result
-        n = n // 2
-    return result
+    return [int(b) for b in bin(n)[2:]]
 
 def bits_to_string(b):
     """concatenates bits to a string of characters. Original code from: https://gist.github.com/barrysteyn/4184435"""
@@ -254,9 +1453,10 @@ def bit_list_to_string(b):
     """converts list of {0, 1}* to string. Original code from: https://gist.github.com/barrysteyn/4184435"""
     return ''.join([BITS[e] for e in b])
 
-# Script runs the following code
-answer = "y"
-while answer == "y":
-    main()
-    answer = input("\nRerun program? (y/n)")
-input("\nPress ENTER to exit")
+# Script runs the following code when it is not imported
+if __name__ == "__main__":
+    answer = "y"
+    while answer == "y":
+        main(sys.argv[1] if len(sys.argv) > 1 else None)
+        answer = input("\nRerun program? (y/n)")
+    input("\nPress ENTER to exit")
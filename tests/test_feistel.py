@@ -0,0 +1,207 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import FeistelCipher
+
+
+def test_sp_tables_match_sbox_and_p32box():
+    assert FeistelCipher.checkSpTables()
+
+
+CODEWORD = 'abcdefgh'
+LENGTHS = range(25)  # every padding length, and inputs of zero to three blocks
+
+
+def message(length):
+    return bytes((i*37 + 11) % 256 for i in range(length))
+
+
+def bits_to_bytes(bits):
+    return FeistelCipher.bitsToInt(bits).to_bytes(len(bits) // 8, 'big')
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+def test_encrypt_round_trip(length):
+    schedule = FeistelCipher.KeySchedule(CODEWORD)
+    ciphertext = FeistelCipher.encrypt(message(length), schedule)
+
+    assert len(ciphertext) == (length // 8 + 1) * 8
+    assert FeistelCipher.decrypt(ciphertext, schedule) == message(length)
+
+
+@pytest.mark.parametrize('backend', FeistelCipher.BACKENDS)
+@pytest.mark.parametrize('length', LENGTHS)
+def test_encryption_round_trip(backend, length):
+    subkeys = FeistelCipher.getSubkeys(CODEWORD)
+    blocks = FeistelCipher.encryption(message(length), 64, 16, subkeys, backend)
+
+    assert bits_to_bytes(FeistelCipher.decryption(blocks, 16, subkeys, backend)) == message(length)
+
+
+def test_backends_agree():
+    subkeys = FeistelCipher.getSubkeys(CODEWORD)
+    blocks = {backend: FeistelCipher.encryption(message(24), 64, 16, subkeys, backend)
+              for backend in FeistelCipher.BACKENDS}
+
+    assert blocks['list'] == blocks['int']
+    assert b''.join(map(bits_to_bytes, blocks['int'])) == FeistelCipher.encrypt(message(24), CODEWORD)
+
+
+@pytest.mark.parametrize('blocksize', [16, 48, 64, 128])
+@pytest.mark.parametrize('length', LENGTHS)
+def test_engine_round_trip(blocksize, length):
+    engine = FeistelCipher.getEngine(blocksize, 8)
+    ciphertext = engine.encrypt(message(length), CODEWORD)
+
+    assert len(ciphertext) % engine.blockbytes == 0 and len(ciphertext) > length
+    assert engine.decrypt(ciphertext, CODEWORD) == message(length)
+
+
+# decrypted last blocks with a zero pad byte, a pad byte larger than the block and inconsistent pad bytes
+BAD_PADDING = [message(8)[:-1] + b'\x00', message(8)[:-1] + b'\x09', message(8)[:-2] + b'\x01\x02']
+
+
+@pytest.mark.parametrize('plaintext', BAD_PADDING)
+def test_bad_padding_is_rejected(plaintext):
+    subkeys = FeistelCipher.getSubkeys(CODEWORD)
+    ciphertext = bytes(FeistelCipher.encryptBytes(message(8) + plaintext, 16, subkeys))
+
+    with pytest.raises(ValueError):
+        FeistelCipher.decrypt(ciphertext, CODEWORD)
+    with pytest.raises(ValueError):
+        FeistelCipher.decryption([FeistelCipher.tobits(ciphertext[i:i+8]) for i in (0, 8)], 16, subkeys, 'int')
+    with pytest.raises(ValueError):
+        b''.join(FeistelCipher.decryptStream(io.BytesIO(ciphertext), CODEWORD))
+
+
+@pytest.mark.parametrize('plaintext', BAD_PADDING)
+def test_engine_bad_padding_is_rejected(plaintext):
+    engine = FeistelCipher.getEngine(64, 8)
+    ciphertext = engine.crypt(engine.encryptBlock, plaintext, engine.subkeys(CODEWORD))
+
+    with pytest.raises(ValueError):
+        engine.decrypt(ciphertext, CODEWORD)
+
+
+@pytest.mark.parametrize('ciphertext', [b'', message(7), message(12)])
+def test_ciphertext_length_is_checked(ciphertext):
+    with pytest.raises(ValueError):
+        FeistelCipher.decrypt(ciphertext, CODEWORD)
+    with pytest.raises(ValueError):
+        FeistelCipher.getEngine(64, 16).decrypt(ciphertext, CODEWORD)
+
+
+class ShortReader(io.RawIOBase):
+    # non-seekable stream that returns at most `most` bytes per read, like a pipe
+
+    def __init__(self, data, most=13):
+        self.data = memoryview(data)
+        self.most = most
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.most, len(self.data))
+        buffer[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+
+@pytest.mark.parametrize('chunksize', [8, 64, 70])
+@pytest.mark.parametrize('length', [0, 7, 8, 9, 63, 64, 65, 127, 128, 129, 200])
+def test_stream_round_trip_at_chunk_boundaries(chunksize, length):
+    ciphertext = b''.join(FeistelCipher.encryptStream(ShortReader(message(length)), CODEWORD, chunksize=chunksize))
+    assert ciphertext == FeistelCipher.encrypt(message(length), CODEWORD)
+
+    plaintext = b''.join(FeistelCipher.decryptStream(ShortReader(ciphertext), CODEWORD, chunksize=chunksize))
+    assert plaintext == message(length)
+
+
+# Runs in a fresh interpreter, so the peak RSS only covers the stream. A generated input goes through
+# encryptStream() and decryptStream() chained by non-seekable readers, and is checked by its hash.
+STREAM_SCRIPT = '''
+import hashlib, io, json, resource, sys
+import FeistelCipher
+
+size = int(sys.argv[1])
+pattern = bytes(range(251)) * 64
+
+
+class Generated(io.RawIOBase):
+    def __init__(self):
+        self.left = size
+        self.digest = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = pattern[:min(len(buffer), len(pattern), self.left)]
+        buffer[:len(data)] = data
+        self.digest.update(data)
+        self.left -= len(data)
+        return len(data)
+
+
+class Chunks(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.pending:
+            self.pending = next(self.chunks, b'')
+        data = self.pending[:len(buffer)]
+        buffer[:len(data)] = data
+        self.pending = self.pending[len(data):]
+        return len(data)
+
+
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+source = Generated()
+digest = hashlib.sha256()
+for chunk in FeistelCipher.decryptStream(Chunks(FeistelCipher.encryptStream(source, 'abcdefgh', 1)), 'abcdefgh', 1):
+    digest.update(chunk)
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+scale = 1 if sys.platform == 'darwin' else 1024  # bytes on macOS, kilobytes elsewhere
+print(json.dumps({'growth': (after - before) * scale, 'same': digest.digest() == source.digest.digest()}))
+'''
+
+
+def test_stream_memory_does_not_grow_with_input():
+    pytest.importorskip('resource')
+    size = int(os.environ.get('FEISTEL_STREAM_TEST_BYTES', 4 << 20))  # raise it for a longer run
+
+    result = subprocess.run([sys.executable, '-c', STREAM_SCRIPT, str(size)], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(FeistelCipher.__file__)), check=True)
+    result = json.loads(result.stdout)
+
+    assert result['same']
+    assert result['growth'] < min(size // 4, 4 << 20)
+
+
+def test_import_time():
+    # generous bounds, they catch work at import time (rebuilt tables, eager heavy imports) but not noise
+    timings = FeistelCipher.importTime()
+
+    assert timings['import'] < 0.2
+    assert timings['firstCall'] < 0.02
+
+
+def test_import_is_lazy():
+    code = ("import sys, FeistelCipher; "
+            "print(sorted({'numpy', 'argparse', 'tempfile', 'concurrent.futures'} & set(sys.modules)))")
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(FeistelCipher.__file__)))
+
+    assert result.stdout.strip() == '[]'
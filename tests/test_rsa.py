@@ -0,0 +1,71 @@
+import os
+import signal
+import threading
+import time
+from concurrent.futures import BrokenExecutor
+
+import pytest
+
+import RSACipher
+
+
+def test_pool_latency_under_a_burst_smaller_than_depth():
+    depth, burst = 8, 6
+    latencies = []
+
+    with RSACipher.KeyPool(512, depth, workers=1) as pool:
+        for _ in range(5):
+            deadline = time.perf_counter() + 30
+            while pool.metrics()['depth'] < depth:
+                assert time.perf_counter() < deadline, "pool did not fill up"
+                time.sleep(0.02)
+
+            for _ in range(burst):
+                start = time.perf_counter()
+                key = pool.get_keypair(timeout=30)
+                latencies.append(time.perf_counter() - start)
+                assert key.decrypt(key.encrypt(42)) == 42
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+    # taking a key from stock never waits for findPrime(), which takes ~20 ms at 512 bits even alone
+    assert p99 < 0.01
+
+
+def test_close_wakes_waiting_callers():
+    # a 3072 bit key takes seconds, so the caller is still waiting when the pool is closed
+    pool = RSACipher.KeyPool(3072, depth=1, workers=1)
+    errors = []
+    woken = threading.Event()
+
+    def wait():
+        try:
+            pool.get_keypair()
+        except RuntimeError as error:
+            errors.append(error)
+        woken.set()
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.1)
+    closer = threading.Thread(target=pool.close)  # close() itself waits for the running job
+    closer.start()
+
+    assert woken.wait(2)
+    assert len(errors) == 1 and 'closed' in str(errors[0])
+    with pytest.raises(RuntimeError):
+        pool.get_keypair(timeout=0)
+
+    waiter.join()
+    closer.join()
+
+
+def test_failed_generation_wakes_waiting_callers():
+    with RSACipher.KeyPool(2048, depth=1, workers=1) as pool:
+        for pid in list(pool.executor._processes):  # a dead worker breaks the process pool
+            os.kill(pid, signal.SIGKILL)
+
+        with pytest.raises(RuntimeError) as error:
+            pool.get_keypair(timeout=10)
+        assert isinstance(error.value.__cause__, BrokenExecutor)
+        assert pool.metrics()['inflight'] == 1  # generation restarted on a new pool